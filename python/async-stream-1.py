@@ -5,9 +5,19 @@ from ollama import AsyncClient
 
 ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 
+# One client (and connection pool) for every chat() call
+CLIENT = AsyncClient(host=ollama_host, timeout=None)
+
 async def chat():
   message = {'role': 'user', 'content': 'Why is the sky blue?'}
-  async for part in await AsyncClient().chat(model='dolphin-mistral', messages=[message], stream=True):
+  async for part in await CLIENT.chat(model='dolphin-mistral', messages=[message], stream=True):
     print(part['message']['content'], end='', flush=True)
 
-asyncio.run(chat())
\ No newline at end of file
+async def main():
+  try:
+    await chat()
+  finally:
+    # Close on the same event loop the connections were opened on
+    await CLIENT._client.aclose()
+
+asyncio.run(main())
\ No newline at end of file
@@ -82,13 +82,39 @@ Feedback ,This is the feedback text,,,
 """
 import os
 import argparse
+import aiofiles
+import asyncio
+import blake3
+import codecs
+import concurrent.futures
+import contextlib
+import functools
+import itertools
 import json
-import requests
+import mmap
+import multiprocessing
+import orjson
+import random
+import re
+import time
+import httpx
 import tiktoken
+from ollama import AsyncClient, ResponseError
 from pathlib import Path
 import logging
-from typing import List, Tuple, Dict
-import time
+from typing import List, Tuple, Dict, Set, Optional, Iterable, Iterator
+
+try:
+    # Optional: batch file I/O through io_uring on Linux
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    # Optional: compiles the token estimator to native code
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Set up logging
 logging.basicConfig(
@@ -96,159 +122,938 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which drowns out our own progress messages
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+@functools.lru_cache(maxsize=8)
+def _get_encoder(name: str) -> tiktoken.Encoding:
+    """Load a tiktoken encoding once per process."""
+    # tiktoken downloads the vocab into a temp dir by default; keep it somewhere that survives reboots
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(Path.home() / ".cache" / "tiktoken"))
+    return tiktoken.get_encoding(name)
+
+# Instructions are sent as the system message and kept byte-identical between requests, so Ollama
+# can reuse the already-processed prompt prefix from its KV cache instead of prefilling it again
+SUMMARY_INSTRUCTIONS = (
+    "Analyze the following study notes and provide a detailed summary "
+    "focusing on key points and main ideas."
+)
+BATCH_SUMMARY_INSTRUCTIONS = (
+    "For each of the following sections of study notes, write a detailed summary "
+    "focusing on key points and main ideas. Output a JSON array of summaries in order, "
+    "one string per section."
+)
+QUIZ_INSTRUCTIONS = (
+    "Based on the content, generate 5 multiple choice questions. "
+    "Format each question as a JSON object with 'question', 'options' (array), "
+    "and 'correct_answer' fields."
+)
+CONCEPT_INSTRUCTIONS = (
+    "Extract and list all key terms, concepts, products, services, and acronyms "
+    "from the content. Format the response as a JSON array of objects with 'term' "
+    "and 'category' fields."
+)
+
+# Errors worth retrying a request for
+OLLAMA_ERRORS = (ResponseError, httpx.HTTPError, ConnectionError)
+
+class OllamaUnavailable(Exception):
+    """Raised for a request that is short-circuited because the circuit breaker is open."""
+
+# Longest backoff between retries of a request, in seconds
+RETRY_MAX_WAIT = 30
+
+# Circuit breaker: after BREAKER_THRESHOLD failed attempts within BREAKER_WINDOW seconds, stop sending
+# requests for BREAKER_COOLDOWN seconds so a stalled server (e.g. OOM on the Pi) fails fast
+BREAKER_THRESHOLD = 5
+BREAKER_WINDOW = 30
+BREAKER_COOLDOWN = 60
+
+# Markdown syntax that costs prompt tokens without adding meaning. Every alternative matches within a
+# single line, so it is safe to apply to any piece of a note. Link text and code are kept (groups 1 and 2).
+# It is only applied outside fenced code blocks, where * _ # and friends are part of the code.
+_MD_STRIP = re.compile(
+    r"(?m)!\[[^\]\n]*\]\([^)\n]*\)"        # images
+    r"|\[([^\]\n]+)\]\([^)\n]*\)"         # links -> link text
+    r"|`([^`\n]+)`"                       # inline code -> code
+    r"|</?[A-Za-z][^>\n]*>"               # inline HTML tags
+    r"|^ {0,3}(?:#{1,6}|>+)[ \t]*"         # heading and blockquote markers
+    r"|(?<!\w)[*_]{1,3}(?=\w)|(?<=\w)[*_]{1,3}(?!\w)"  # emphasis markers hugging a word
+)
+# Opening or closing line of a fenced code block
+_FENCE = re.compile(r"(?m)^[ \t]*(?:```|~~~).*$")
+
+def _strip_markup(text: str) -> str:
+    """Apply _MD_STRIP to text that is known to be outside any code block."""
+    return _MD_STRIP.sub(lambda m: m.group(1) or m.group(2) or "", text)
+
+def _iter_plaintext(pieces: Iterable[str]) -> Iterator[str]:
+    """Strip markdown markup from consecutive pieces of a note, keeping fenced code as written.
+
+    Drops the fence lines themselves. Whether a piece starts inside a code block carries over from
+    the piece before it, so a fence can open in one paragraph and close in a later one.
+    """
+    in_fence = False
+    for piece in pieces:
+        parts = _FENCE.split(piece)
+        stripped = []
+        for i, part in enumerate(parts):
+            if i:
+                in_fence = not in_fence
+            stripped.append(part if in_fence else _strip_markup(part))
+        yield "".join(stripped)
+
+def _to_plaintext(markdown_text: str) -> str:
+    """Strip markdown markup, leaving the text the model actually needs to read."""
+    return next(_iter_plaintext([markdown_text]))
+
+# Models like to wrap JSON in prose or code fences
+_JSON_FENCE = re.compile(r"```(?:json)?[ \t]*\n(.*?)\n[ \t]*```", re.S)
+_JSON_START = re.compile(r"[\[{]")
+_JSON_DECODER = json.JSONDecoder()
+
+def _safe_json(text: str):
+    """Parse the JSON in a model reply, or return None if there isn't any."""
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    for match in _JSON_FENCE.finditer(text):
+        try:
+            return orjson.loads(match.group(1))
+        except orjson.JSONDecodeError:
+            continue
+    # Otherwise take the first array or object that parses, wherever it starts and whatever follows it
+    return next(_iter_json_values(text), None)
+
+def _iter_json_values(text: str) -> Iterator:
+    """Yield each JSON array or object embedded in text, left to right."""
+    pos = 0
+    while True:
+        match = _JSON_START.search(text, pos)
+        if not match:
+            return
+        try:
+            value, pos = _JSON_DECODER.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            pos = match.start() + 1
+            continue
+        yield value
+
+def _json_records(text: str) -> Optional[List[Dict]]:
+    """Pull the JSON objects out of a model reply, such as quiz questions or concepts.
+
+    Accepts an array of objects, a lone object, or several objects one after another (e.g. a
+    numbered list), inside or outside code fences. Returns None if the reply holds no objects.
+    """
+    try:
+        values = [orjson.loads(text)]
+    except orjson.JSONDecodeError:
+        fenced = [match.group(1) for match in _JSON_FENCE.finditer(text)]
+        values = _iter_json_values("\n".join(fenced) if fenced else text)
+    records = []
+    for value in values:
+        if isinstance(value, dict):
+            records.append(value)
+        elif isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            records.extend(value)
+    return records or None
+
+# Rough characters-per-token ratio for English text; good enough for picking chunk boundaries
+CHARS_PER_TOKEN = 4
+# Target chunk size in tokens, leaving room under token_limit for the instructions
+CHUNK_SIZE = 1500
+
+# Notes bigger than this are memory-mapped and chunked a window at a time instead of read whole
+LARGE_NOTE_BYTES = 1024 * 1024
+MMAP_WINDOW = 64 * 1024
+# Longest unfinished paragraph held while looking for the next paragraph break
+MAX_CARRY = 16 * MMAP_WINDOW
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def _pack(pieces: List[str], separator: str, max_chars: int) -> List[str]:
+    """Greedily join pieces with separator into strings of at most max_chars."""
+    packed = []
+    current = []
+    current_len = 0
+    for piece in pieces:
+        if current and current_len + len(separator) + len(piece) > max_chars:
+            packed.append(separator.join(current))
+            current = []
+            current_len = 0
+        current_len += len(piece) + (len(separator) if current else 0)
+        current.append(piece)
+    if current:
+        packed.append(separator.join(current))
+    return packed
+
+if njit is not None:
+    @njit(cache=True)
+    def _count_words(data: bytes) -> int:
+        """Count runs of non-whitespace bytes."""
+        count = 0
+        in_word = False
+        for byte in data:
+            if byte == 32 or 9 <= byte <= 13:
+                in_word = False
+            elif not in_word:
+                in_word = True
+                count += 1
+        return count
+else:
+    def _count_words(data: bytes) -> int:
+        """Count runs of non-whitespace bytes."""
+        return len(data.split())
+
+def estimate_tokens(text: str) -> int:
+    """Cheaply estimate a token count as 4 tokens per 3 words, for sizing decisions that don't need tiktoken."""
+    return _count_words(text.encode("utf-8")) * 4 // 3
+
+def _split_by_chars(paragraphs: Iterable[str], chunk_size: int) -> List[str]:
+    """Split paragraphs into chunks of roughly chunk_size tokens, estimated from character counts."""
+    max_chars = chunk_size * CHARS_PER_TOKEN
+    pieces = []
+    for paragraph in paragraphs:
+        if not paragraph.strip():
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        # Paragraph is too big on its own, so fall back to sentences (and hard cuts for run-ons)
+        sentences = []
+        for sentence in _SENTENCE_END.split(paragraph):
+            sentences.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars))
+        pieces.extend(_pack(sentences, " ", max_chars))
+    return _pack(pieces, "\n\n", max_chars)
+
+def _split_by_tokens(paragraphs: Iterable[str], chunk_size: int, num_threads: int) -> List[str]:
+    """Split paragraphs into chunks of at most chunk_size tokens."""
+    encoder = _get_encoder("cl100k_base")
+    separator = encoder.encode_ordinary("\n\n")
+    paragraphs = (p for p in paragraphs if p.strip())
+
+    chunks = []
+    finished = []
+    current = []
+    while True:
+        # Tokenize a batch of paragraphs at a time so a huge note is never held as one token list
+        batch = list(itertools.islice(paragraphs, 1024))
+        if not batch:
+            break
+        # The batch calls tokenize on tiktoken's native thread pool and skip the special-token scan
+        for tokens in encoder.encode_ordinary_batch(batch, num_threads=num_threads):
+            # Paragraphs longer than a whole chunk get cut at chunk_size tokens
+            for i in range(0, len(tokens), chunk_size):
+                piece = tokens[i:i + chunk_size]
+                if current and len(current) + len(separator) + len(piece) > chunk_size:
+                    finished.append(current)
+                    current = []
+                if current:
+                    current.extend(separator)
+                current.extend(piece)
+        chunks.extend(encoder.decode_batch(finished, num_threads=num_threads))
+        finished = []
+    if current:
+        chunks.append(encoder.decode(current))
+    return chunks
+
+def _iter_mmap_windows(filepath: Path) -> Iterator[str]:
+    """Decode a file MMAP_WINDOW bytes at a time through mmap, so only the current window is resident.
+
+    Line endings come out as \n, as when reading the file in text mode.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    carry = ""
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start in range(0, len(mm), MMAP_WINDOW):
+            # The incremental decoder holds back a multi-byte character split across two windows,
+            # and a trailing \r is held back in case the next window starts with its \n
+            window = carry + decoder.decode(mm[start:start + MMAP_WINDOW])
+            carry = "\r" if window.endswith("\r") else ""
+            yield window[:len(window) - len(carry)].replace("\r\n", "\n")
+        yield (carry + decoder.decode(b"", final=True)).replace("\r\n", "\n")
+
+def _iter_paragraphs(windows: Iterable[str]) -> Iterator[str]:
+    """Reassemble paragraphs from text that arrives in arbitrary windows."""
+    carry = ""
+    for window in windows:
+        paragraphs = (carry + window).replace("\r\n", "\n").split("\n\n")
+        carry = paragraphs.pop()
+        yield from paragraphs
+        if len(carry) > MAX_CARRY:
+            # No paragraph break in sight; hand it on in pieces rather than growing it forever
+            yield carry
+            carry = ""
+    if carry:
+        yield carry
+
+def preprocess_markdown(markdown_text: str, exact_chunks: bool = False,
+                        chunk_size: int = CHUNK_SIZE) -> Tuple[int, List[str]]:
+    """Turn a note into prompt-sized chunks of plain text, returned with the note's length in characters.
+
+    This is the CPU-bound part of handling a note, so it runs in a worker process. Only the length
+    is sent back rather than the plain text, which the caller doesn't need.
+    """
+    text = _to_plaintext(markdown_text)
+    if exact_chunks:
+        # The process pool already spreads notes across the cores
+        return len(markdown_text), _split_by_tokens(text.split("\n\n"), chunk_size, num_threads=1)
+    return len(markdown_text), _split_by_chars(text.split("\n\n"), chunk_size)
+
+def preprocess_markdown_file(filepath: Path, exact_chunks: bool = False,
+                             chunk_size: int = CHUNK_SIZE) -> Tuple[int, List[str]]:
+    """Like preprocess_markdown, but reads a large note window by window.
+
+    The whole note is never held as a single string, on top of the chunks made from it.
+    """
+    length = 0
+
+    def counted(windows: Iterable[str]) -> Iterator[str]:
+        nonlocal length
+        for window in windows:
+            length += len(window)
+            yield window
+
+    paragraphs = _iter_plaintext(_iter_paragraphs(counted(_iter_mmap_windows(filepath))))
+    if exact_chunks:
+        chunks = _split_by_tokens(paragraphs, chunk_size, num_threads=1)
+    else:
+        chunks = _split_by_chars(paragraphs, chunk_size)
+    return length, chunks
+
+# Number of reads/writes queued on the io_uring before each submit
+URING_DEPTH = 64
+
+def _uring_read_files(paths: List[Path], max_size: int) -> Dict[Path, bytes]:
+    """Read whole files through io_uring, submitting up to URING_DEPTH reads per syscall.
+
+    Files larger than max_size, or that come back short, are left out so the caller can read them
+    the normal way.
+    """
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(URING_DEPTH, ring)
+    contents = {}
+    try:
+        for start in range(0, len(paths), URING_DEPTH):
+            batch = paths[start:start + URING_DEPTH]
+            opened = []
+            fds = []
+            try:
+                for path in batch:
+                    try:
+                        fds.append(os.open(path, os.O_RDONLY))
+                    except OSError:
+                        # e.g. a dangling symlink or a note deleted since the scan; the regular read reports it
+                        continue
+                    opened.append(path)
+                sizes = [os.fstat(fd).st_size for fd in fds]
+                buffers = [bytearray(size) if size <= max_size else None for size in sizes]
+                queued = 0
+                for i, (fd, buffer) in enumerate(zip(fds, buffers)):
+                    if buffer is None:
+                        continue
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, fd, buffer, 0)
+                    liburing.io_uring_sqe_set_data64(sqe, i)
+                    queued += 1
+                liburing.io_uring_submit(ring)
+                for _ in range(queued):
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    entry = cqe[0]
+                    i = entry.user_data
+                    try:
+                        # The bindings raise OSError for a failed read (e.g. a directory named *.md)
+                        result = entry.res
+                    except OSError:
+                        continue
+                    finally:
+                        liburing.io_uring_cqe_seen(ring, entry)
+                    if result == len(buffers[i]):
+                        contents[opened[i]] = bytes(buffers[i])
+            finally:
+                for fd in fds:
+                    os.close(fd)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+    return contents
+
+def _uring_write_files(files: Dict[Path, bytes]):
+    """Write several files with a single io_uring submit."""
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(max(len(files), 1), ring)
+    paths = list(files)
+    fds = []
+    try:
+        for path in paths:
+            fds.append(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+        for i, (path, fd) in enumerate(zip(paths, fds)):
+            sqe = liburing.io_uring_get_sqe(ring)
+            liburing.io_uring_prep_write(sqe, fd, files[path], 0)
+            liburing.io_uring_sqe_set_data64(sqe, i)
+        liburing.io_uring_submit(ring)
+        for _ in paths:
+            liburing.io_uring_wait_cqe(ring, cqe)
+            entry = cqe[0]
+            i = entry.user_data
+            try:
+                result = entry.res
+            finally:
+                liburing.io_uring_cqe_seen(ring, entry)
+            if result != len(files[paths[i]]):
+                raise OSError(f"Short write to {paths[i]} ({result} of {len(files[paths[i]])} bytes)")
+    finally:
+        for fd in fds:
+            os.close(fd)
+        liburing.io_uring_queue_exit(ring)
+
+def _parse_keep_alive(value: str):
+    """Convert an OLLAMA_KEEP_ALIVE value to what the API accepts.
+
+    The server parses string values as durations (e.g. "1h"), so plain seconds, and -1 for
+    forever, have to be sent as numbers.
+    """
+    for number in (int, float):
+        try:
+            return number(value)
+        except ValueError:
+            continue
+    return value
 
 class MarkdownAnalyzer:
-    def __init__(self, model: str, notes_dir: str, results_dir: str):
+    def __init__(self, model: str, notes_dir: str, results_dir: str, exact_chunks: bool = False):
         self.model = model
         self.notes_dir = Path(notes_dir)
         self.results_dir = Path(results_dir)
         self.ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+        # Keep the model (and its prompt cache) loaded between requests
+        self.keep_alive = _parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "1h"))
         self.token_limit = 2048
-        self.encoder = tiktoken.get_encoding("cl100k_base")
+        # Cut chunks on exact token counts with tiktoken rather than estimating from character counts
+        self.exact_chunks = exact_chunks
+        self.tokenizer_threads = os.cpu_count() or 1
+        # Upper bound on in-flight Ollama requests, matched to the server's OLLAMA_NUM_PARALLEL
+        self.num_parallel = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+        # Created inside the event loop by _run()
+        self._client = None
+        self._semaphore = None
+        self._pool = None
+        self._breaker = {"failures": 0, "first_failure": 0.0, "opened_at": 0.0}
+        # Switched off for the rest of the run the first time io_uring fails (e.g. blocked by seccomp)
+        self._use_uring = liburing is not None
+        # Note -> the batch of notes it is read with, and batch -> its in-progress (or finished) read
+        self._prefetch_batches = {}
+        self._prefetch_reads = {}
         
         # Create results directory if it doesn't exist
         self.results_dir.mkdir(parents=True, exist_ok=True)
 
+        # Notes that already have a full set of results, one JSON string per line
+        self.index_file = self.results_dir / ".index.jsonl"
+        self._completed = self.load_index()
+
+        # Responses keyed by a hash of the model and the whole prompt, so re-running a note (or an
+        # identical chunk in another note) doesn't send the same prompt again
+        self.prompt_cache_dir = self.results_dir / ".prompt_cache"
+        self.prompt_cache_dir.mkdir(exist_ok=True)
+
+    @property
+    def encoder(self) -> tiktoken.Encoding:
+        """Tokenizer, only loaded when something actually needs exact token counts."""
+        return _get_encoder("cl100k_base")
+
     def get_markdown_files(self) -> List[Path]:
         """Recursively find all markdown files in the given directory."""
-        return list(self.notes_dir.rglob("*.md"))
+        return [path for path in self.notes_dir.rglob("*.md") if path.is_file()]
 
-    def read_markdown_file(self, filepath: Path) -> str:
-        """Read a markdown file and return its contents as text."""
+    async def read_markdown_file(self, filepath: Path, prefetched: Optional[bytes] = None) -> str:
+        """Read a markdown file and return its contents as text, using the prefetched bytes if given."""
         try:
-            return filepath.read_text(encoding="utf-8")
+            if prefetched is not None:
+                markdown_text = prefetched.decode("utf-8").replace("\r\n", "\n")
+            else:
+                async with aiofiles.open(filepath, 'r', encoding='utf-8') as f:
+                    markdown_text = await f.read()
         except Exception as e:
             logger.error(f"Error reading file {filepath}: {e}")
             return ""
+        return markdown_text
+
+    async def save_json(self, filepath: Path, data):
+        """Write data to a JSON file in the results directory."""
+        async with aiofiles.open(filepath, 'wb') as f:
+            await f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+    async def save_results(self, base_name: str, summary_data: Dict, quiz_questions: List[Dict], concepts: List[Dict]):
+        """Write the summary, quiz questions and concepts for a note to the results directory."""
+        results = {
+            self.results_dir / f"{base_name}_summary.json": summary_data,
+            self.results_dir / f"{base_name}_quiz.json": quiz_questions,
+            self.results_dir / f"{base_name}_concepts.json": concepts,
+        }
+        if self._use_uring:
+            encoded = {path: orjson.dumps(data, option=orjson.OPT_INDENT_2) for path, data in results.items()}
+            try:
+                await asyncio.to_thread(_uring_write_files, encoded)
+                return
+            except Exception as e:
+                self._disable_uring(e)
+        await asyncio.gather(*(self.save_json(path, data) for path, data in results.items()))
+
+    def schedule_prefetch(self, md_files: List[Path]):
+        """Split the given markdown files into io_uring read batches of URING_DEPTH, if available.
+
+        A batch is read when the first of its files is reached, so only the notes about to be
+        processed are held in memory.
+        """
+        if not self._use_uring:
+            return
+        for start in range(0, len(md_files), URING_DEPTH):
+            batch = tuple(md_files[start:start + URING_DEPTH])
+            self._prefetch_batches.update(dict.fromkeys(batch, batch))
+
+    async def take_prefetched(self, filepath: Path) -> Optional[bytes]:
+        """Return the file's contents from its io_uring batch, or None if it has to be read the regular way."""
+        batch = self._prefetch_batches.pop(filepath, None)
+        if batch is None:
+            return None
+        read = self._prefetch_reads.get(batch)
+        if read is None:
+            if not self._use_uring:
+                return None
+            read = self._prefetch_reads[batch] = asyncio.ensure_future(
+                asyncio.to_thread(_uring_read_files, list(batch), LARGE_NOTE_BYTES)
+            )
+        if not any(path in self._prefetch_batches for path in batch):
+            # Last file of the batch to be reached, so its contents can be let go once this one is taken
+            del self._prefetch_reads[batch]
+        try:
+            contents = await read
+        except Exception as e:
+            self._disable_uring(e)
+            return None
+        return contents.pop(filepath, None)
+
+    def _disable_uring(self, error: Exception):
+        """Fall back to regular file I/O for the rest of the run."""
+        if not self._use_uring:
+            return
+        logger.warning(f"io_uring unavailable, falling back to regular file I/O: {error}")
+        self._use_uring = False
+
+    def load_index(self) -> Set[str]:
+        """Load the names of notes that have already been processed."""
+        if not self.index_file.exists():
+            return self._build_index()
+
+        completed = set()
+        with open(self.index_file, 'rb') as f:
+            for line in f:
+                try:
+                    completed.add(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # A run that was killed mid-append can leave a partial last line
+                    continue
+        return completed
+
+    def _build_index(self) -> Set[str]:
+        """Seed the index from result files written before it existed, with a single directory scan."""
+        names = {entry.name for entry in os.scandir(self.results_dir)}
+        completed = {
+            name[:-len("_concepts.json")]
+            for name in names
+            if name.endswith("_concepts.json")
+        }
+        completed = {
+            base_name for base_name in completed
+            if f"{base_name}_summary.json" in names and f"{base_name}_quiz.json" in names
+        }
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, 'wb') as f:
+            f.writelines(orjson.dumps(base_name) + b"\n" for base_name in sorted(completed))
+        os.replace(tmp_file, self.index_file)
+        return completed
+
+    async def mark_completed(self, base_name: str):
+        """Record a note as processed so later runs skip it."""
+        self._completed.add(base_name)
+        async with aiofiles.open(self.index_file, 'ab') as f:
+            await f.write(orjson.dumps(base_name) + b"\n")
 
     def check_existing_results(self, md_file: Path) -> bool:
         """Check if results already exist for the given markdown file."""
-        base_name = md_file.stem
-        summary_file = self.results_dir / f"{base_name}_summary.json"
-        quiz_file = self.results_dir / f"{base_name}_quiz.json"
-        concept_file = self.results_dir / f"{base_name}_concepts.json"
-        return all(f.exists() for f in [summary_file, quiz_file, concept_file])
-
-    def query_ollama(self, prompt: str, retries: int = 3) -> str:
-        """Send a request to Ollama with retry logic."""
-        for attempt in range(retries):
+        return md_file.stem in self._completed
+
+    async def query_ollama(self, instructions: str, content: str, retries: int = 3,
+                           cache: bool = True) -> Optional[str]:
+        """Send a request to Ollama with retry logic, returning None if it couldn't be answered.
+
+        With cache=False a fresh response isn't saved, so the caller can check it first and
+        save it with cache_response.
+        """
+        cache_path = self._prompt_cache_path(instructions, content)
+        cached = await self._read_cached_response(cache_path)
+        if cached is not None:
+            return cached
+
+        if self._breaker_is_open():
+            logger.warning("Ollama looks unavailable, skipping request until the cool-off ends")
+            return None
+
+        messages = [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": content},
+        ]
+        response = await self._query_ollama_with_retry(messages, retries)
+        if response and cache:
+            await self._write_cached_response(cache_path, response)
+        return response
+
+    async def cache_response(self, instructions: str, content: str, response: str):
+        """Save a response that the caller has checked, unless it is already cached."""
+        cache_path = self._prompt_cache_path(instructions, content)
+        if response and not cache_path.exists():
+            await self._write_cached_response(cache_path, response)
+
+    def evict_cached_response(self, instructions: str, content: str):
+        """Drop an unusable response, so the prompt is sent to Ollama again next time."""
+        self._prompt_cache_path(instructions, content).unlink(missing_ok=True)
+
+    def _prompt_cache_path(self, instructions: str, content: str) -> Path:
+        """Location of the cached response for this model and prompt."""
+        key = blake3.blake3("\0".join((self.model, instructions, content)).encode("utf-8")).hexdigest()
+        return self.prompt_cache_dir / f"{key}.json"
+
+    async def _write_cached_response(self, cache_path: Path, response: str):
+        """Save a response under its cache key."""
+        async with aiofiles.open(cache_path, 'wb') as f:
+            await f.write(orjson.dumps({"response": response}))
+
+    async def _read_cached_response(self, cache_path: Path) -> Optional[str]:
+        """Return a previously saved response, or None if there isn't a usable one."""
+        try:
+            async with aiofiles.open(cache_path, 'rb') as f:
+                return orjson.loads(await f.read())["response"]
+        except FileNotFoundError:
+            return None
+        except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+            # Unreadable or half-written entry: treat it as a miss and let it be overwritten
+            return None
+
+    async def _query_ollama_fast(self, messages: List[Dict]) -> str:
+        """Hot path: a single streamed chat request, with no error handling of its own."""
+        async with self._semaphore:
+            if self._breaker_is_open():
+                # The breaker opened while this request was queued for a slot
+                raise OllamaUnavailable
+            # Stream so Ollama sends tokens as they're generated instead of one body at the end
+            parts = []
+            async for part in await self._client.chat(
+                model=self.model, messages=messages, stream=True, keep_alive=self.keep_alive
+            ):
+                parts.append(part["message"]["content"])
+        return "".join(parts)
+
+    async def _query_ollama_with_retry(self, messages: List[Dict], retries: int) -> Optional[str]:
+        """Run the request, handing any failure to the out-of-line retry logic."""
+        try:
+            response = await self._query_ollama_fast(messages)
+        except OllamaUnavailable:
+            logger.warning("Ollama looks unavailable, skipping request until the cool-off ends")
+            return None
+        except OLLAMA_ERRORS as error:
+            return await self._on_query_failure(messages, retries, error)
+        self._breaker["failures"] = 0
+        return response
+
+    async def _on_query_failure(self, messages: List[Dict], retries: int, error: Exception) -> Optional[str]:
+        """Cold path: record the failed attempt, then retry with jittered exponential backoff."""
+        attempt = 1
+        while True:
+            self._record_failure(attempt, error)
+            if attempt >= retries or self._breaker_is_open():
+                logger.error(f"Failed to query Ollama after {attempt} attempts")
+                return None
+            # Jittered so concurrent requests that failed together don't all retry together
+            await asyncio.sleep(random.uniform(0, min(RETRY_MAX_WAIT, 2 ** (attempt - 1))))
+            attempt += 1
             try:
-                response = requests.post(
-                    f"{self.ollama_host}/api/generate",
-                    json={
-                        "prompt": prompt,
-                        "model": self.model,
-                        "stream": False
-                    },
-                    timeout=60 * 60
-                )
-                response.raise_for_status()
-                return response.json().get("response", "")
-            except requests.RequestException as e:
-                logger.warning(f"Attempt {attempt + 1} failed: {e}")
-                if attempt < retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
-                else:
-                    logger.error(f"Failed to query Ollama after {retries} attempts")
-                    return ""
-
-    def split_text_into_chunks(self, text: str, chunk_size: int = 1500) -> List[str]:
-        """Split text into chunks that fit within token limits."""
-        tokens = self.encoder.encode(text)
-        chunks = []
-        for i in range(0, len(tokens), chunk_size):
-            chunk_tokens = tokens[i:i + chunk_size]
-            chunks.append(self.encoder.decode(chunk_tokens))
+                response = await self._query_ollama_fast(messages)
+            except OllamaUnavailable:
+                logger.error(f"Failed to query Ollama after {attempt - 1} attempts")
+                return None
+            except OLLAMA_ERRORS as retry_error:
+                error = retry_error
+                continue
+            self._breaker["failures"] = 0
+            return response
+
+    def _record_failure(self, attempt: int, error: Exception):
+        """Log a failed attempt and open the circuit breaker if failures are piling up."""
+        logger.warning(f"Attempt {attempt} failed: {type(error).__name__}: {error}")
+        now = time.monotonic()
+        breaker = self._breaker
+        if now - breaker["first_failure"] > BREAKER_WINDOW:
+            breaker["failures"] = 0
+            breaker["first_failure"] = now
+        breaker["failures"] += 1
+        if breaker["failures"] >= BREAKER_THRESHOLD and not breaker["opened_at"]:
+            logger.error(
+                f"{breaker['failures']} failed Ollama requests within {BREAKER_WINDOW}s, "
+                f"pausing for {BREAKER_COOLDOWN}s"
+            )
+            breaker["opened_at"] = now
+
+    def _breaker_is_open(self) -> bool:
+        """Check whether requests should currently be short-circuited."""
+        breaker = self._breaker
+        if not breaker["opened_at"]:
+            return False
+        if time.monotonic() - breaker["opened_at"] < BREAKER_COOLDOWN:
+            return True
+        # Cool-off is over: let requests through again, but a single further failure re-opens it
+        breaker["opened_at"] = 0.0
+        breaker["failures"] = BREAKER_THRESHOLD - 1
+        breaker["first_failure"] = time.monotonic()
+        return False
+
+    def split_text_into_chunks(self, text: str, chunk_size: int = CHUNK_SIZE) -> List[str]:
+        """Split text into chunks of roughly chunk_size tokens, breaking between paragraphs."""
+        if self.exact_chunks:
+            chunks = _split_by_tokens(text.split("\n\n"), chunk_size, self.tokenizer_threads)
+        else:
+            chunks = _split_by_chars(text.split("\n\n"), chunk_size)
+        if logger.isEnabledFor(logging.DEBUG):
+            self._log_chunk_tokens(chunks)
         return chunks
 
-    def analyze_content(self, content: str) -> Tuple[Dict, List[Dict], List[Dict]]:
-        """Generate summary, quiz questions, and extract key concepts."""
-        # Process content in chunks
-        chunks = self.split_text_into_chunks(content)
-        summaries = []
-        
-        # Generate summaries for each chunk
+    def _log_chunk_tokens(self, chunks: List[str]):
+        """Debug aid: report how the character-based chunks measure up in real tokens."""
+        counts = [len(t) for t in self.encoder.encode_ordinary_batch(chunks, num_threads=self.tokenizer_threads)]
+        for i, (chunk, tokens) in enumerate(zip(chunks, counts), 1):
+            logger.debug(f"Chunk {i}/{len(chunks)}: {len(chunk)} chars, {tokens} tokens")
+            if tokens > self.token_limit:
+                logger.warning(f"Chunk {i} is {tokens} tokens, over the {self.token_limit} token limit")
+
+    def _group_chunks(self, chunks: List[str]) -> List[List[str]]:
+        """Group consecutive chunks so each group can be summarized in one prompt under token_limit."""
+        groups = []
+        current = []
+        current_tokens = 0
         for chunk in chunks:
-            summary_prompt = (
-                "Analyze the following study notes and provide a detailed summary "
-                "focusing on key points and main ideas:\n\n" + chunk
-            )
-            summary = self.query_ollama(summary_prompt)
-            if summary:
-                summaries.append(summary)
+            tokens = estimate_tokens(chunk)
+            if current and current_tokens + tokens > self.token_limit:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(chunk)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    async def _summarize_chunks(self, chunks: List[str]) -> List[Optional[str]]:
+        """Summarize one or more chunks, asking for all of them in a single request where possible.
+
+        A chunk whose summary couldn't be fetched from Ollama gets None.
+        """
+        if len(chunks) == 1:
+            return [await self.query_ollama(SUMMARY_INSTRUCTIONS, chunks[0])]
+
+        sections = "\n".join(f"### Section {i}:\n{chunk}\n" for i, chunk in enumerate(chunks, 1))
+        content = f"There are {len(chunks)} sections.\n\n" + sections
+        response = await self.query_ollama(BATCH_SUMMARY_INSTRUCTIONS, content, cache=False)
+        if response is None:
+            return [None] * len(chunks)
+        summaries = _safe_json(response)
+        if isinstance(summaries, list) and len(summaries) == len(chunks) and all(isinstance(s, str) for s in summaries):
+            await self.cache_response(BATCH_SUMMARY_INSTRUCTIONS, content, response)
+            return summaries
+        self.evict_cached_response(BATCH_SUMMARY_INSTRUCTIONS, content)
+
+        logger.warning(f"Failed to parse batched summary of {len(chunks)} chunks, summarizing them one at a time")
+        return [summary for group in await asyncio.gather(*(self._summarize_chunks([chunk]) for chunk in chunks))
+                for summary in group]
+
+    async def _query_json(self, instructions: str, content: str, kind: str):
+        """Ask for a list of JSON objects, or wrap the raw text in the structure expected for kind if there isn't one.
+
+        Only replies that hold objects are cached. Returns None if Ollama couldn't be reached.
+        """
+        response = await self.query_ollama(instructions, content, cache=False)
+        if response is None:
+            return None
+        parsed = _json_records(response)
+        if parsed is None:
+            self.evict_cached_response(instructions, content)
+            return self._fallback_structure(response, kind)
+        await self.cache_response(instructions, content, response)
+        return parsed
+
+    @staticmethod
+    def _fallback_structure(text: str, kind: str) -> List[Dict]:
+        """Cold path: keep an unparseable reply as a single entry so it isn't lost."""
+        logger.warning(f"Failed to parse {kind} as JSON, generating structured format")
+        if kind == "quiz questions":
+            return [{"question": text, "options": [], "correct_answer": ""}]
+        return [{"term": text, "category": "uncategorized"}]
+
+    async def _gather_logged(self, tasks: List[asyncio.Future], name: str, kind: str) -> list:
+        """Wait for the tasks, logging progress as each finishes. Failed tasks come back as their exception."""
+        for completed, task in enumerate(asyncio.as_completed(tasks), 1):
+            with contextlib.suppress(Exception):
+                await task
+            logger.info(f"{name}: completed {completed}/{len(tasks)} {kind} prompts")
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Ollama request failed: {result}")
+        return results
+
+    async def analyze_content(self, content: str, chunks: Optional[List[str]] = None,
+                              name: str = "") -> Optional[Tuple[Dict, List[Dict], List[Dict]]]:
+        """Generate summary, quiz questions, and extract key concepts.
+
+        Returns None if any of the requests failed, so incomplete results are never saved.
+        """
+        # Process content in chunks
+        if chunks is None:
+            chunks = self.split_text_into_chunks(content)
+        return await self.analyze_chunks(chunks, len(content), name)
+
+    async def analyze_chunks(self, chunks: List[str], length: int,
+                             name: str = "") -> Optional[Tuple[Dict, List[Dict], List[Dict]]]:
+        """Like analyze_content, for a note that has already been split into chunks of length characters."""
+        # The chunk summaries don't depend on each other, so send them all at once
+        groups = self._group_chunks(chunks)
+        tasks = [asyncio.ensure_future(self._summarize_chunks(group)) for group in groups]
+        results = await self._gather_logged(tasks, name, "summary")
+        if any(isinstance(r, Exception) or None in r for r in results):
+            return None
+        summaries = [summary for group_summaries in results for summary in group_summaries if summary]
 
         full_summary = "\n".join(summaries)
 
-        # Generate quiz questions
-        quiz_prompt = (
-            "Based on the content, generate 5 multiple choice questions. "
-            "Format each question as a JSON object with 'question', 'options' (array), "
-            "and 'correct_answer' fields."
-        )
-        quiz_response = self.query_ollama(quiz_prompt)
-        
-        try:
-            quiz_questions = json.loads(quiz_response)
-        except json.JSONDecodeError:
-            logger.warning("Failed to parse quiz questions as JSON, generating structured format")
-            quiz_questions = [{"question": quiz_response, "options": [], "correct_answer": ""}]
-
-        # Extract key concepts
-        concept_prompt = (
-            "Extract and list all key terms, concepts, products, services, and acronyms "
-            "from the content. Format the response as a JSON array of objects with 'term' "
-            "and 'category' fields."
-        )
-        concept_response = self.query_ollama(concept_prompt)
-        
-        try:
-            concepts = json.loads(concept_response)
-        except json.JSONDecodeError:
-            logger.warning("Failed to parse concepts as JSON, generating structured format")
-            concepts = [{"term": concept_response, "category": "uncategorized"}]
+        # The quiz and concepts are drawn from the summary, since the note itself may not fit in the
+        # context. A long summary is chunked the same way as the note and each chunk is asked about.
+        digests = self.split_text_into_chunks(full_summary) or [full_summary]
+        tasks = []
+        for digest in digests:
+            tasks += [asyncio.ensure_future(self._query_json(QUIZ_INSTRUCTIONS, digest, "quiz questions")),
+                      asyncio.ensure_future(self._query_json(CONCEPT_INSTRUCTIONS, digest, "concepts"))]
+        results = await self._gather_logged(tasks, name, "quiz and concept")
+        if any(isinstance(r, Exception) or r is None for r in results):
+            return None
+        quiz_questions = [question for questions in results[0::2] for question in questions]
+        concepts = [concept for group_concepts in results[1::2] for concept in group_concepts]
 
         return {
             "summary": full_summary,
-            "length": len(content),
+            "length": length,
             "chunks_processed": len(chunks)
         }, quiz_questions, concepts
 
     def process_files(self):
         """Process all markdown files and generate analysis results."""
+        asyncio.run(self._run())
+
+    async def _run(self):
+        """Open a shared Ollama client for this run and process the markdown files concurrently."""
         md_files = self.get_markdown_files()
         logger.info(f"Found {len(md_files)} markdown files to process")
 
+        pending = []
         for md_file in md_files:
             if self.check_existing_results(md_file):
                 logger.info(f"Skipping {md_file.name}, results already exist")
-                continue
+            else:
+                pending.append(md_file)
+        self.schedule_prefetch(pending)
 
+        # One pooled connection per request slot, kept alive between prompts so only the first
+        # request on each slot pays for the TCP (and TLS) handshake
+        self._client = AsyncClient(
+            host=self.ollama_host,
+            timeout=60 * 60,
+            limits=httpx.Limits(
+                max_connections=self.num_parallel,
+                max_keepalive_connections=self.num_parallel,
+                keepalive_expiry=60,
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(self.num_parallel)
+        # Limits how many files are in progress at once; each one keeps several requests queued
+        file_semaphore = asyncio.Semaphore(self.num_parallel)
+        # Worker processes for the CPU-bound markdown preprocessing, while this event loop handles I/O
+        # Not forked: aiofiles and to_thread already have threads running, and forking then can deadlock
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(start_method)
+        )
+        try:
+            if hasattr(asyncio, "TaskGroup"):
+                # Python 3.11+: if one file fails, the files still in flight are cancelled cleanly
+                async with asyncio.TaskGroup() as group:
+                    for md_file in pending:
+                        group.create_task(self._process_file(md_file, file_semaphore))
+            else:
+                await asyncio.gather(*(self._process_file(md_file, file_semaphore) for md_file in pending))
+        finally:
+            await self._client._client.aclose()
+            self._pool.shutdown(cancel_futures=True)
+
+    async def _process_file(self, md_file: Path, sem: asyncio.Semaphore):
+        """Analyze a single markdown file and save its results."""
+        async with sem:
             logger.info(f"Processing {md_file.name}")
-            content = self.read_markdown_file(md_file)
-            
-            if not content:
-                continue
+            loop = asyncio.get_running_loop()
+            prefetched = await self.take_prefetched(md_file)
+            try:
+                large = prefetched is None and md_file.stat().st_size > LARGE_NOTE_BYTES
+            except OSError as e:
+                # e.g. a dangling symlink, or a note deleted since the scan
+                logger.error(f"Error reading file {md_file}: {e}")
+                return
+            if not large:
+                markdown_text = await self.read_markdown_file(md_file, prefetched)
 
-            summary_data, quiz_questions, concepts = self.analyze_content(content)
-            
-            # Save results
-            base_name = md_file.stem
-            
-            # Save summary
-            summary_file = self.results_dir / f"{base_name}_summary.json"
-            with open(summary_file, 'w', encoding='utf-8') as f:
-                json.dump(summary_data, f, indent=2, ensure_ascii=False)
-
-            # Save quiz questions
-            quiz_file = self.results_dir / f"{base_name}_quiz.json"
-            with open(quiz_file, 'w', encoding='utf-8') as f:
-                json.dump(quiz_questions, f, indent=2, ensure_ascii=False)
-
-            # Save concepts
-            concept_file = self.results_dir / f"{base_name}_concepts.json"
-            with open(concept_file, 'w', encoding='utf-8') as f:
-                json.dump(concepts, f, indent=2, ensure_ascii=False)
+                if not markdown_text:
+                    return
 
+                try:
+                    length, chunks = await loop.run_in_executor(
+                        self._pool, preprocess_markdown, markdown_text, self.exact_chunks
+                    )
+                except Exception as e:
+                    # e.g. the tokenizer vocab couldn't be downloaded for --exact-chunks
+                    logger.error(f"Error preprocessing file {md_file}: {e}")
+                    return
+            else:
+                # Large note: the worker maps it and chunks it a window at a time
+                try:
+                    length, chunks = await loop.run_in_executor(
+                        self._pool, preprocess_markdown_file, md_file, self.exact_chunks
+                    )
+                except Exception as e:
+                    logger.error(f"Error reading file {md_file}: {e}")
+                    return
+                # The chunks are all that is needed from here on, so the note is never put back together
+            tokens = sum(estimate_tokens(chunk) for chunk in chunks)
+            logger.info(f"{md_file.name}: about {tokens} tokens in {len(chunks)} chunks")
+            if logger.isEnabledFor(logging.DEBUG):
+                self._log_chunk_tokens(chunks)
+
+            analysis = await self.analyze_chunks(chunks, length, md_file.name)
+            if analysis is None:
+                # Some of the answers are missing, so don't save (and index) incomplete results
+                logger.warning(f"Not saving {md_file.name}, some Ollama requests failed; it will be retried next run")
+                return
+
+            summary_data, quiz_questions, concepts = analysis
+            await self.save_results(md_file.stem, summary_data, quiz_questions, concepts)
+            await self.mark_completed(md_file.stem)
             logger.info(f"Successfully processed {md_file.name}")
 
 def main():
@@ -256,9 +1061,14 @@ def main():
     parser.add_argument("--model", default="dolphin-mistral", help="Ollama model to use")
     parser.add_argument("--notes-dir", default="./notes", help="Directory containing markdown notes")
     parser.add_argument("--results-dir", default="./results", help="Directory to store results")
+    parser.add_argument("--exact-chunks", action="store_true", help="Split notes on exact tiktoken token counts (slower)")
+    parser.add_argument("--debug", action="store_true", help="Verbose logging, including exact token counts per chunk")
     args = parser.parse_args()
 
-    analyzer = MarkdownAnalyzer(args.model, args.notes_dir, args.results_dir)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    analyzer = MarkdownAnalyzer(args.model, args.notes_dir, args.results_dir, exact_chunks=args.exact_chunks)
     analyzer.process_files()
 
 if __name__ == "__main__":
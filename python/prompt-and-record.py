@@ -23,6 +23,12 @@ args = parser.parse_args()
 # Set Ollama host from environment variable or default to localhost
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 
+# Flush the results file every FLUSH_EVERY streamed tokens rather than after each one
+FLUSH_EVERY = 32
+
+# One client (and connection pool) for every chat() call
+CLIENT = AsyncClient(host=OLLAMA_HOST, timeout=None)
+
 # Determine the prompt source (priority: command-line > markdown file > default)
 if args.prompt:
     prompt = args.prompt
@@ -47,16 +53,25 @@ else:
 
 async def chat():
     message = {'role': 'user', 'content': prompt}
-    
-    client = AsyncClient(host=OLLAMA_HOST)
-    
-    with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
-        async for part in await client.chat(args.model, messages=[message], stream=True):
+
+    with open(OUTPUT_FILE, "a", encoding="utf-8", buffering=8192) as f:
+        tokens = 0
+        async for part in await CLIENT.chat(args.model, messages=[message], stream=True):
             content = part['message']['content']
             print(content, end='', flush=True)  # Stream to console
             f.write(content)  # Write to file
-            f.flush()  # Ensure immediate write to disk
+            tokens += 1
+            if tokens % FLUSH_EVERY == 0:
+                f.flush()  # Keep the file current without a disk write per token
+        f.flush()
+
+async def main():
+    try:
+        await chat()
+    finally:
+        # Close on the same event loop the connections were opened on
+        await CLIENT._client.aclose()
 
-asyncio.run(chat())
+asyncio.run(main())
 
 print(f"\nOutput saved to {OUTPUT_FILE}")
\ No newline at end of file
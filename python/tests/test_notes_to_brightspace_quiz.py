@@ -0,0 +1,324 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# numba's on-disk cache is keyed by file, not module name, so keep the copy compiled under this
+# module's name away from the one the script itself uses
+os.environ.setdefault("NUMBA_CACHE_DIR", tempfile.mkdtemp(prefix="numba-"))
+
+# The script's file name isn't a valid module name, so load it by path
+_SCRIPT = Path(__file__).resolve().parent.parent / "notes-to-brightspace-quiz.py"
+_spec = importlib.util.spec_from_file_location("notes_to_brightspace_quiz", _SCRIPT)
+quiz = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = quiz
+_spec.loader.exec_module(quiz)
+
+
+def test_to_plaintext_strips_markup():
+    text = "# Title\n> Some **bold**, _em_ and [a link](http://example.com) with `code`.\n![img](a.png)"
+    assert quiz._to_plaintext(text) == "Title\nSome bold, em and a link with code.\n"
+
+
+def test_to_plaintext_keeps_fenced_code():
+    text = "Intro *here*\n```python\ndef __init__(self, *args, **kwargs):\n    # set up\n```\nAfter **it**"
+    assert quiz._to_plaintext(text) == (
+        "Intro here\n\ndef __init__(self, *args, **kwargs):\n    # set up\n\nAfter it"
+    )
+
+
+def test_iter_plaintext_carries_fence_across_pieces():
+    pieces = ["```", "    # one **x**", "```", "# Heading"]
+    assert list(quiz._iter_plaintext(pieces)) == ["", "    # one **x**", "", "Heading"]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('[{"q": 1}]', [{"q": 1}]),
+    ('Here you go:\n```json\n[1, 2]\n```\nSee [docs].', [1, 2]),
+    ('[{"q": 1}]\n\nNote: see [docs].', [{"q": 1}]),
+    ('Sure! {"term": "x"} and [more]', {"term": "x"}),
+    ("no json [here", None),
+    ("", None),
+])
+def test_safe_json(text, expected):
+    assert quiz._safe_json(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('[{"q": 1}, {"q": 2}]', [{"q": 1}, {"q": 2}]),
+    ('{"q": 1}', [{"q": 1}]),
+    ('1. {"q": 1}\n2. {"q": 2}\n3. {"q": 3}', [{"q": 1}, {"q": 2}, {"q": 3}]),
+    ('Here you go:\n```json\n[{"q": 1}]\n```\nSee [docs].', [{"q": 1}]),
+    ('[{"q": 1}]\n\nNote: see [docs].', [{"q": 1}]),
+    ("Key terms: TCP [1], UDP [2]", None),
+    ('See [docs], then [3]', None),
+    ('"I cannot help with that."', None),
+    ("[]", None),
+])
+def test_json_records(text, expected):
+    assert quiz._json_records(text) == expected
+
+
+def test_iter_paragraphs_reassembles_windows():
+    windows = ["first para", "graph\r", "\n\r\nsecond\n", "\nthird"]
+    assert list(quiz._iter_paragraphs(windows)) == ["first paragraph", "second", "third"]
+
+
+def test_iter_paragraphs_hands_on_overlong_carry(monkeypatch):
+    monkeypatch.setattr(quiz, "MAX_CARRY", 8)
+    assert list(quiz._iter_paragraphs(["abcdef", "ghijkl", "\n\nend"])) == ["abcdefghijkl", "", "end"]
+
+
+def test_iter_mmap_windows_splits_multibyte_characters(tmp_path, monkeypatch):
+    monkeypatch.setattr(quiz, "MMAP_WINDOW", 3)
+    text = "naïve café – ünïcödé\n\nsecond"
+    note = tmp_path / "note.md"
+    note.write_bytes(text.encode("utf-8"))
+    assert "".join(quiz._iter_mmap_windows(note)) == text
+
+
+@pytest.mark.parametrize("value, expected", [("1h", "1h"), ("30m", "30m"), ("300", 300), ("-1", -1), ("1.5", 1.5)])
+def test_parse_keep_alive(value, expected):
+    assert quiz._parse_keep_alive(value) == expected
+    assert type(quiz._parse_keep_alive(value)) is type(expected)
+
+
+def test_pack_respects_max_chars():
+    assert quiz._pack(["aa", "bb", "cc", "dddd"], " ", 5) == ["aa bb", "cc", "dddd"]
+
+
+def test_split_by_chars_keeps_chunks_under_limit():
+    paragraphs = ["short one", "", "x" * 50, "Sentence one. Sentence two! " * 5]
+    chunks = quiz._split_by_chars(paragraphs, chunk_size=5)
+    assert chunks
+    assert all(len(chunk) <= 5 * quiz.CHARS_PER_TOKEN for chunk in chunks)
+    assert "".join(chunks).replace("\n", "").replace(" ", "") == "".join(paragraphs).replace(" ", "")
+
+
+def test_split_by_tokens_keeps_chunks_under_limit():
+    paragraphs = [f"Paragraph {i} talks about subject {i} at some length." for i in range(40)]
+    paragraphs.append("word " * 300)
+    chunks = quiz._split_by_tokens(paragraphs, chunk_size=50, num_threads=1)
+    encoder = quiz._get_encoder("cl100k_base")
+    assert all(len(encoder.encode_ordinary(chunk)) <= 50 for chunk in chunks)
+    assert "".join("".join(chunks).split()) == "".join("".join(paragraphs).split())
+
+
+def test_preprocess_markdown_file_matches_in_memory_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(quiz, "MMAP_WINDOW", 16)
+    text = "\n\n".join(f"## Part {i}\nSome *notes* about part {i}." for i in range(30))
+    note = tmp_path / "note.md"
+    note.write_text(text, encoding="utf-8")
+    length, chunks = quiz.preprocess_markdown(text, chunk_size=40)
+    assert length == len(text)
+    assert quiz.preprocess_markdown_file(note, chunk_size=40) == (length, chunks)
+
+
+def test_preprocess_markdown_file_counts_crlf_as_one_character(tmp_path, monkeypatch):
+    monkeypatch.setattr(quiz, "MMAP_WINDOW", 4)
+    text = "line one\r\nline two\r\n\r\nnext para\r\n"
+    note = tmp_path / "note.md"
+    note.write_bytes(text.encode("utf-8"))
+    assert "".join(quiz._iter_mmap_windows(note)) == text.replace("\r\n", "\n")
+    assert quiz.preprocess_markdown_file(note)[0] == len(text.replace("\r\n", "\n"))
+
+
+class StubClient:
+    """Stands in for ollama.AsyncClient. reply(messages) gives the reply text, or an exception to raise."""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.requests = []
+
+    async def chat(self, model, messages, stream, keep_alive):
+        self.requests.append(messages)
+        reply = self.reply(messages)
+        if isinstance(reply, Exception):
+            raise reply
+
+        async def parts():
+            for i in range(0, len(reply), 5):
+                yield {"message": {"content": reply[i:i + 5]}}
+        return parts()
+
+
+def _run(analyzer, coro):
+    """Run coro in a fresh event loop, with the semaphore the analyzer normally gets from _run()."""
+    async def main():
+        analyzer._semaphore = asyncio.Semaphore(2)
+        return await coro
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def make_analyzer(tmp_path, monkeypatch):
+    # No waiting between retries
+    monkeypatch.setattr(quiz.random, "uniform", lambda low, high: 0)
+
+    def make(reply=lambda messages: "ok", model="test-model"):
+        analyzer = quiz.MarkdownAnalyzer(model, str(tmp_path / "notes"), str(tmp_path / "results"))
+        analyzer._client = StubClient(reply)
+        return analyzer
+    return make
+
+
+def test_index_is_seeded_from_complete_result_sets(tmp_path, make_analyzer):
+    results = tmp_path / "results"
+    results.mkdir()
+    for suffix in ("summary", "quiz", "concepts"):
+        (results / f"done_{suffix}.json").write_text("{}")
+    (results / "partial_summary.json").write_text("{}")
+    analyzer = make_analyzer()
+    assert analyzer._completed == {"done"}
+    assert (results / ".index.jsonl").read_text() == '"done"\n'
+
+
+def test_index_ignores_a_partial_last_line(tmp_path, make_analyzer):
+    results = tmp_path / "results"
+    results.mkdir()
+    (results / ".index.jsonl").write_text('"first"\n"second"\n"thi')
+    assert make_analyzer()._completed == {"first", "second"}
+
+
+def test_completed_notes_are_skipped_on_later_runs(make_analyzer):
+    analyzer = make_analyzer()
+    assert not analyzer.check_existing_results(Path("notes/topic.md"))
+    _run(analyzer, analyzer.mark_completed("topic"))
+    assert make_analyzer().check_existing_results(Path("notes/sub/topic.md"))
+
+
+def _flaky(failures, reply="answer"):
+    """A reply function that raises ConnectionError for the first `failures` requests."""
+    calls = []
+
+    def reply_for(messages):
+        calls.append(messages)
+        return ConnectionError("refused") if len(calls) <= failures else reply
+    return reply_for
+
+
+def test_query_retries_then_succeeds(make_analyzer):
+    analyzer = make_analyzer(_flaky(2))
+    assert _run(analyzer, analyzer.query_ollama("instructions", "content")) == "answer"
+    assert len(analyzer._client.requests) == 3
+    assert analyzer._breaker["failures"] == 0
+
+
+def test_query_gives_up_after_retries(make_analyzer):
+    analyzer = make_analyzer(_flaky(10))
+    assert _run(analyzer, analyzer.query_ollama("instructions", "content", retries=3)) is None
+    assert len(analyzer._client.requests) == 3
+
+
+def test_breaker_opens_and_short_circuits(make_analyzer):
+    analyzer = make_analyzer(lambda messages: ConnectionError("refused"))
+
+    async def queries():
+        return [await analyzer.query_ollama("instructions", f"content {i}", retries=1) for i in range(8)]
+    assert _run(analyzer, queries()) == [None] * 8
+    assert len(analyzer._client.requests) == quiz.BREAKER_THRESHOLD
+    assert analyzer._breaker_is_open()
+
+
+def test_breaker_is_checked_again_after_waiting_for_a_slot(make_analyzer):
+    analyzer = make_analyzer()
+    analyzer._breaker["opened_at"] = quiz.time.monotonic()
+    with pytest.raises(quiz.OllamaUnavailable):
+        _run(analyzer, analyzer._query_ollama_fast([]))
+    assert analyzer._client.requests == []
+
+
+def test_analysis_is_not_returned_when_a_request_fails(make_analyzer):
+    def reply(messages):
+        if "multiple choice" in messages[0]["content"]:
+            return ConnectionError("refused")
+        return '[{"term": "x", "category": "y"}]' if "'term'" in messages[0]["content"] else "a summary"
+    analyzer = make_analyzer(reply)
+    assert _run(analyzer, analyzer.analyze_content("Some notes.")) is None
+
+
+def test_analysis_combines_summary_quiz_and_concepts(make_analyzer):
+    def reply(messages):
+        if "multiple choice" in messages[0]["content"]:
+            return '[{"question": "q?", "options": ["a", "b"], "correct_answer": "a"}]'
+        return '[{"term": "x", "category": "y"}]' if "'term'" in messages[0]["content"] else "a summary"
+    analyzer = make_analyzer(reply)
+    summary, questions, concepts = _run(analyzer, analyzer.analyze_content("Some notes."))
+    assert summary == {"summary": "a summary", "length": len("Some notes."), "chunks_processed": 1}
+    assert questions == [{"question": "q?", "options": ["a", "b"], "correct_answer": "a"}]
+    assert concepts == [{"term": "x", "category": "y"}]
+
+
+def test_cached_response_is_reused(make_analyzer):
+    analyzer = make_analyzer()
+    assert _run(analyzer, analyzer.query_ollama("instructions", "content")) == "ok"
+    assert _run(analyzer, analyzer.query_ollama("instructions", "content")) == "ok"
+    assert len(analyzer._client.requests) == 1
+
+
+def test_cache_is_keyed_by_model(make_analyzer):
+    first = make_analyzer(model="one")
+    _run(first, first.query_ollama("instructions", "content"))
+    second = make_analyzer(model="two")
+    _run(second, second.query_ollama("instructions", "content"))
+    assert len(second._client.requests) == 1
+
+
+def test_only_parsed_json_replies_are_cached(make_analyzer):
+    analyzer = make_analyzer(lambda messages: "no json here")
+    for _ in range(2):
+        questions = _run(analyzer, analyzer._query_json(quiz.QUIZ_INSTRUCTIONS, "content", "quiz questions"))
+        assert questions == [{"question": "no json here", "options": [], "correct_answer": ""}]
+    assert len(analyzer._client.requests) == 2
+    assert list(analyzer.prompt_cache_dir.iterdir()) == []
+
+    analyzer._client.reply = lambda messages: '[{"question": "q?"}]'
+    for _ in range(2):
+        questions = _run(analyzer, analyzer._query_json(quiz.QUIZ_INSTRUCTIONS, "content", "quiz questions"))
+        assert questions == [{"question": "q?"}]
+    assert len(analyzer._client.requests) == 3
+
+
+def test_unusable_cached_reply_is_evicted(make_analyzer):
+    analyzer = make_analyzer(lambda messages: '[{"term": "x", "category": "y"}]')
+    cache_path = analyzer._prompt_cache_path(quiz.CONCEPT_INSTRUCTIONS, "content")
+    cache_path.write_bytes(b'{"response": "Key terms: TCP [1]"}')
+    concepts = _run(analyzer, analyzer._query_json(quiz.CONCEPT_INSTRUCTIONS, "content", "concepts"))
+    assert concepts == [{"term": "Key terms: TCP [1]", "category": "uncategorized"}]
+    assert not cache_path.exists()
+    concepts = _run(analyzer, analyzer._query_json(quiz.CONCEPT_INSTRUCTIONS, "content", "concepts"))
+    assert concepts == [{"term": "x", "category": "y"}]
+    assert cache_path.exists()
+
+
+def test_chunks_are_summarized_in_one_batched_request(make_analyzer):
+    analyzer = make_analyzer(lambda messages: 'Here:\n["first", "second"]')
+    assert _run(analyzer, analyzer._summarize_chunks(["chunk one", "chunk two"])) == ["first", "second"]
+    assert len(analyzer._client.requests) == 1
+    assert "There are 2 sections." in analyzer._client.requests[0][1]["content"]
+
+
+@pytest.mark.parametrize("batch_reply", ["not json", '["only one"]', '[1, 2]'])
+def test_unusable_batched_summary_falls_back_to_one_request_per_chunk(make_analyzer, batch_reply):
+    def reply(messages):
+        if messages[0]["content"] == quiz.BATCH_SUMMARY_INSTRUCTIONS:
+            return batch_reply
+        return "summary of " + messages[1]["content"]
+    analyzer = make_analyzer(reply)
+    summaries = _run(analyzer, analyzer._summarize_chunks(["chunk one", "chunk two"]))
+    assert summaries == ["summary of chunk one", "summary of chunk two"]
+    assert len(analyzer._client.requests) == 3
+    batch_content = analyzer._client.requests[0][1]["content"]
+    assert not analyzer._prompt_cache_path(quiz.BATCH_SUMMARY_INSTRUCTIONS, batch_content).exists()
+
+
+def test_small_chunks_are_grouped_under_the_token_limit(make_analyzer):
+    analyzer = make_analyzer()
+    chunk = "word " * 600
+    groups = analyzer._group_chunks([chunk] * 5)
+    assert [len(group) for group in groups] == [2, 2, 1]
+    assert all(sum(quiz.estimate_tokens(c) for c in group) <= analyzer.token_limit for group in groups)